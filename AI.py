@@ -1,34 +1,171 @@
 import streamlit as st
-import json
+import hashlib
+import io
+import random
+import threading
+import time
+import orjson
 import requests
-from PyPDF2 import PdfReader
-from pptx import Presentation
+from concurrent.futures import ThreadPoolExecutor
+from streamlit.runtime.uploaded_file_manager import UploadedFile
 
 # ================== CONFIG ==================
-API_KEY = st.secrets["OPENROUTER_API_KEY"]
-st.write("API Key loaded?", bool(API_KEY))  # True if loaded correctly
-
 MODEL = "deepseek/deepseek-chat-v3.1:free"
 BASE_URL = "https://openrouter.ai/api/v1/chat/completions"
+REQUESTS_PER_MINUTE = 20  # OpenRouter's limit for free models
+MAX_RETRIES = 4
+MAX_RETRY_DELAY = 30  # seconds; longer Retry-After waits fail instead of freezing the page
+REQUEST_TIMEOUT = 60  # seconds
 
 # ================== HELPER FUNCTION ==================
-def ask_openrouter(prompt, notes):
-    payload = {
-        "model": MODEL,
-        "messages": [
-            {"role": "system", "content": prompt},
-            {"role": "user", "content": "Notes:\n" + notes}
-        ]
-    }
-    headers = {
-        "Authorization": f"Bearer {API_KEY}",
+def build_payload(prompt_name, notes):
+    # Copy the prebuilt template and fill in only the user message
+    template = PAYLOADS[prompt_name]
+    payload = dict(template)
+    payload["messages"] = [*template["messages"], {"role": "user", "content": "Notes:\n" + notes}]
+    return payload
+
+def auth_headers():
+    return {
+        "Authorization": f"Bearer {st.secrets['OPENROUTER_API_KEY']}",
         "Content-Type": "application/json"
     }
-    response = requests.post(BASE_URL, headers=headers, data=json.dumps(payload))
-    response.raise_for_status()
-    data = response.json()
+
+# One pooled session per process keeps the TLS connection to OpenRouter warm across reruns.
+@st.cache_resource
+def get_http_session():
+    session = requests.Session()
+    session.headers.update(auth_headers())
+    return session
+
+# Token bucket shared by every session in the process, so button mashing
+# waits for a free slot locally instead of burning retries on 429s.
+@st.cache_resource
+def get_rate_limiter():
+    return {"lock": threading.Lock(), "tokens": float(REQUESTS_PER_MINUTE), "updated": time.monotonic()}
+
+def wait_for_rate_limit():
+    limiter = get_rate_limiter()
+    with limiter["lock"]:
+        now = time.monotonic()
+        refill = (now - limiter["updated"]) * REQUESTS_PER_MINUTE / 60
+        limiter["tokens"] = min(REQUESTS_PER_MINUTE, limiter["tokens"] + refill)
+        limiter["updated"] = now
+        # Take the token now (possibly going negative) so later callers queue behind us
+        wait = max(0.0, 1 - limiter["tokens"]) * 60 / REQUESTS_PER_MINUTE
+        limiter["tokens"] -= 1
+    if wait:
+        time.sleep(wait)
+
+def post_openrouter(payload, stream=False):
+    for attempt in range(MAX_RETRIES + 1):
+        wait_for_rate_limit()
+        response = get_http_session().post(
+            BASE_URL, data=orjson.dumps(payload), stream=stream, timeout=REQUEST_TIMEOUT
+        )
+        if response.status_code != 429 or attempt == MAX_RETRIES:
+            response.raise_for_status()
+            return response
+        response.close()
+        try:
+            delay = float(response.headers.get("Retry-After"))
+        except (TypeError, ValueError):
+            delay = 0.0
+        # Missing, zero, negative or NaN Retry-After: use exponential backoff
+        if not delay > 0:
+            delay = 2 ** attempt + random.random()
+        if delay > MAX_RETRY_DELAY:
+            response.raise_for_status()
+        time.sleep(delay)
+
+# Responses are cached on disk per (template, notes, day) so repeat clicks and app
+# restarts skip the network. persist="disk" ignores ttl, so the day bucket expires
+# entries instead: a new day means a new key and a fresh response.
+# st.cache_data only hashes arguments, not globals like PAYLOADS or MODEL, so the
+# template's hash is passed in: editing a prompt or the model invalidates old entries.
+# The key is read from st.secrets inside so it never becomes part of the cache key.
+@st.cache_data(persist="disk", max_entries=100, show_spinner=False)
+def fetch_openrouter(prompt_name: str, template_key: str, notes: str, day: int) -> str:
+    payload = build_payload(prompt_name, notes)
+    response = post_openrouter(payload)
+    data = orjson.loads(response.content)
     return data["choices"][0]["message"]["content"]
 
+def ask_openrouter(prompt_name, notes):
+    return fetch_openrouter(prompt_name, PAYLOAD_KEYS[prompt_name], notes, int(time.time() // 86400))
+
+def check_all_data(all_data):
+    # Raise unless every section has the shape the tabs render
+    sections = {key: all_data[key] for key in ["multiple_choice", "feynman", "practice_test", "summary"]}
+    for key in ["multiple_choice", "practice_test"]:
+        if not isinstance(sections[key], list) or not all(isinstance(q, dict) for q in sections[key]):
+            raise ValueError(f"'{key}' must be a list of questions")
+    for key in ["feynman", "summary"]:
+        if not isinstance(sections[key], str):
+            raise ValueError(f"'{key}' must be text")
+    return sections
+
+def generate_all(notes):
+    # One combined request sends the notes once and uses a single rate-limit slot.
+    # Request errors propagate; only an unusable response falls back.
+    response_text = ask_openrouter("combined", notes)
+    try:
+        return check_all_data(orjson.loads(response_text))
+    except (KeyError, TypeError, ValueError):  # orjson.JSONDecodeError is a ValueError
+        pass
+    # The combined JSON was unusable: fall back to the per-tab prompts, run side by side
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = {name: executor.submit(ask_openrouter, name, notes) for name in ["quiz", "feynman", "practice_test", "summary"]}
+        results = {name: future.result() for name, future in futures.items()}
+    return check_all_data({
+        "multiple_choice": orjson.loads(results["quiz"])["multiple_choice"],
+        "feynman": results["feynman"],
+        "practice_test": orjson.loads(results["practice_test"])["practice_test"],
+        "summary": results["summary"],
+    })
+
+# Plain-text tabs render tokens as they arrive via st.write_stream.
+# Not cached: a generator can't be replayed from st.cache_data.
+def stream_openrouter(prompt_name, notes):
+    payload = build_payload(prompt_name, notes)
+    payload["stream"] = True
+    with post_openrouter(payload, stream=True) as response:
+        for raw_line in response.iter_lines():
+            line = raw_line.decode("utf-8")
+            # Skip blank separators and ": keep-alive" comment lines
+            if not line.startswith("data: "):
+                continue
+            chunk = line[len("data: "):]
+            if chunk == "[DONE]":
+                break
+            delta = orjson.loads(chunk)["choices"][0]["delta"]
+            if delta.get("content"):
+                yield delta["content"]
+
+def notes_ready(notes):
+    # Never spend a request on empty notes
+    if not notes or not notes.strip():
+        st.warning("Paste notes or upload a file first.")
+        return False
+    return True
+
+def notes_hash(notes):
+    return hashlib.blake2b(notes.encode("utf-8"), digest_size=16).hexdigest()
+
+def already_generated(key, notes):
+    # True if st.session_state[key] was produced from exactly these notes
+    return key in st.session_state and st.session_state.get(f"{key}_notes_hash") == notes_hash(notes)
+
+def remember_notes(key, notes):
+    st.session_state[f"{key}_notes_hash"] = notes_hash(notes)
+
+def prepare_practice_test(questions):
+    # Normalise string answers once so grading doesn't redo it on every submit
+    for q in questions:
+        if isinstance(q.get("answer"), str):
+            q["_norm_answer"] = q["answer"].strip().lower()
+    return questions
+
 # ================== PROMPTS ==================
 QUIZ_PROMPT = """You are an expert teacher creating practice tests. 
 I will provide you with a set of notes on a topic. 
@@ -112,9 +249,76 @@ Rules:
 - Do not include lists unless necessary.
 """
 
+COMBINED_PROMPT = """You are an expert teacher. 
+I will provide you with a set of notes. 
+Create a quiz, a Feynman-style explanation, a practice test and a summary of the notes.
+Return ONLY valid JSON. No markdown, no extra text.
+
+The JSON must look like this:
+
+{
+  "multiple_choice": [
+    {
+      "question": "string",
+      "options": ["Option A", "Option B", "Option C", "Option D"],
+      "answer": "Option X"
+    }
+  ],
+  "feynman": "string",
+  "practice_test": [
+    {
+      "type": "multiple_choice",
+      "question": "string",
+      "options": ["Option A", "Option B", "Option C", "Option D"],
+      "answer": "Option X"
+    },
+    {
+      "type": "true_false",
+      "question": "string",
+      "answer": true
+    },
+    {
+      "type": "fill_blank",
+      "question": "The capital of France is ____.",
+      "answer": "Paris"
+    },
+    {
+      "type": "open_question",
+      "question": "Explain the causes of World War II."
+    }
+  ],
+  "summary": "string"
+}
+
+Rules:
+- "multiple_choice" is the quiz: every question has exactly 4 distinct options and the answer exactly matches one of them.
+- "feynman" explains the concepts as if teaching a 12-year-old, using analogies, simple words and short sentences.
+- "practice_test" mixes the four question types. Multiple-choice has 4 options, true/false answers are booleans,
+  fill-in-the-blank uses '____' for the blank, and open questions have no answer field.
+- "summary" is 1–3 short paragraphs of simple, clear sentences.
+- Do not include ```json fences or any explanation.
+"""
+
+# Request bodies are built once at import; each call only adds the notes
+PAYLOADS = {
+    name: {"model": MODEL, "messages": [{"role": "system", "content": prompt}]}
+    for name, prompt in [
+        ("quiz", QUIZ_PROMPT),
+        ("feynman", FEYNMAN_PROMPT),
+        ("practice_test", PRACTICE_TEST_PROMPT),
+        ("summary", SUMMARY_PROMPT),
+        ("combined", COMBINED_PROMPT),
+    ]
+}
+PAYLOAD_KEYS = {name: hashlib.blake2b(orjson.dumps(t), digest_size=16).hexdigest() for name, t in PAYLOADS.items()}
+
 # ================== PAGE SETUP ==================
 st.set_page_config(page_title="AI Study App", page_icon="📘", layout="centered")
 
+if "OPENROUTER_API_KEY" not in st.secrets:
+    st.error("OPENROUTER_API_KEY is missing from the app secrets.")
+    st.stop()
+
 st.markdown("""
 <style>
 .main-title { text-align: center; font-size: 2.5em; margin-bottom: 0; }
@@ -136,32 +340,75 @@ with col1:
 with col2:
     uploaded_ppt = st.file_uploader("📂 Upload a PowerPoint", type=["pptx"])
 
+# Extraction is cached on disk by a hash of the file contents, so reruns (every
+# widget click), app restarts and other users uploading the same file don't
+# re-parse it.
+UPLOAD_HASH_FUNCS = {UploadedFile: lambda f: hashlib.blake2b(f.getvalue(), digest_size=16).digest()}
+
+@st.cache_data(persist="disk", max_entries=100, show_spinner=False, hash_funcs=UPLOAD_HASH_FUNCS)
+def extract_pdf_text(uploaded_file: UploadedFile) -> str:
+    # Imported here so cold starts without an upload don't pay for it
+    import fitz
+
+    # Write each page straight into one buffer so large PDFs never hold
+    # a per-page list of strings alongside the final text
+    buf = io.StringIO()
+    with fitz.open(stream=uploaded_file.getvalue(), filetype="pdf") as doc:
+        for page in doc:
+            buf.write(page.get_text())
+            buf.write("\n")
+    return buf.getvalue().strip()
+
+@st.cache_data(persist="disk", max_entries=100, show_spinner=False, hash_funcs=UPLOAD_HASH_FUNCS)
+def extract_text_from_pptx(uploaded_file: UploadedFile) -> str:
+    from pptx import Presentation
+
+    prs = Presentation(io.BytesIO(uploaded_file.getvalue()))
+    return "\n".join(shape.text for slide in prs.slides for shape in slide.shapes if getattr(shape, "text", None)).strip()
+
 if uploaded_pdf:
-    pdf_reader = PdfReader(uploaded_pdf)
-    notes = "\n".join([page.extract_text() or "" for page in pdf_reader.pages]).strip()
+    notes = extract_pdf_text(uploaded_pdf)
     st.success("✅ PDF uploaded and converted to text!")
 
-def extract_text_from_pptx(file):
-    prs = Presentation(file)
-    return "\n".join([shape.text for slide in prs.slides for shape in slide.shapes if hasattr(shape, "text")]).strip()
-
 if uploaded_ppt:
     notes = extract_text_from_pptx(uploaded_ppt)
     st.success("✅ PowerPoint uploaded and converted to text!")
 
+# ================== GENERATE ALL ==================
+if st.button("🚀 Generate All") and notes_ready(notes):
+    with st.spinner("Generating quiz, explanation, practice test and summary..."):
+        try:
+            # Build every value before touching session state, so a failure
+            # can't leave it half old, half new
+            all_data = generate_all(notes)
+            practice_test = prepare_practice_test(all_data["practice_test"])
+            st.session_state.quiz = all_data["multiple_choice"]
+            st.session_state.user_answers = {}
+            st.session_state.feynman_explanation = all_data["feynman"]
+            st.session_state.practice_test = practice_test
+            st.session_state.practice_answers = {}
+            st.session_state.summary = all_data["summary"]
+            for key in ["quiz", "feynman_explanation", "practice_test", "summary"]:
+                remember_notes(key, notes)
+            st.success("Everything generated!")
+        except Exception as e:
+            st.error(f"Failed: {e}")
+
 # ================== FUNCTION CHOICES ==================
-tabs = st.tabs(["📝 Quiz", "🧠 Feynman", "📑 Practice Test", "📖 Summary"])
+# Each tab is a fragment, so answering a question only reruns that tab.
 
 # -------------------- QUIZ TAB --------------------
-with tabs[0]:
+@st.fragment
+def render_quiz_tab(notes):
     st.subheader("Generate a Quiz from Notes")
-    if st.button("⚡ Create Quiz"):
+    if st.button("⚡ Create Quiz") and notes_ready(notes) and not already_generated("quiz", notes):
         with st.spinner("Generating quiz..."):
             try:
-                response_text = ask_openrouter(QUIZ_PROMPT, notes)
-                quiz_data = json.loads(response_text)
+                response_text = ask_openrouter("quiz", notes)
+                quiz_data = orjson.loads(response_text)
                 st.session_state.quiz = quiz_data["multiple_choice"]
                 st.session_state.user_answers = {}
+                remember_notes("quiz", notes)
                 st.success("Quiz generated successfully!")
             except Exception as e:
                 st.error(f"Failed to generate quiz: {e}")
@@ -186,28 +433,31 @@ with tabs[0]:
             st.subheader(f"Final Score: {correct} / {total}")
 
 # -------------------- FEYNMAN TAB --------------------
-with tabs[1]:
+@st.fragment
+def render_feynman_tab(notes):
     st.subheader("Explain with Feynman Technique")
-    if st.button("💡 Simplify Notes"):
-        with st.spinner("Explaining..."):
-            try:
-                st.session_state.feynman_explanation = ask_openrouter(FEYNMAN_PROMPT, notes)
-                st.success("Explanation generated!")
-            except Exception as e:
-                st.error(f"Failed: {e}")
-    if "feynman_explanation" in st.session_state:
+    if st.button("💡 Simplify Notes") and notes_ready(notes) and not already_generated("feynman_explanation", notes):
+        try:
+            st.session_state.feynman_explanation = st.write_stream(stream_openrouter("feynman", notes))
+            remember_notes("feynman_explanation", notes)
+            st.success("Explanation generated!")
+        except Exception as e:
+            st.error(f"Failed: {e}")
+    elif "feynman_explanation" in st.session_state:
         st.write(st.session_state.feynman_explanation)
 
 # -------------------- PRACTICE TEST TAB --------------------
-with tabs[2]:
+@st.fragment
+def render_practice_test_tab(notes):
     st.subheader("Generate a Practice Test")
-    if st.button("📝 Create Practice Test"):
+    if st.button("📝 Create Practice Test") and notes_ready(notes) and not already_generated("practice_test", notes):
         with st.spinner("Generating practice test..."):
             try:
-                response_text = ask_openrouter(PRACTICE_TEST_PROMPT, notes)
-                practice_data = json.loads(response_text)
-                st.session_state.practice_test = practice_data["practice_test"]
+                response_text = ask_openrouter("practice_test", notes)
+                practice_data = orjson.loads(response_text)
+                st.session_state.practice_test = prepare_practice_test(practice_data["practice_test"])
                 st.session_state.practice_answers = {}
+                remember_notes("practice_test", notes)
                 st.success("Practice test generated successfully!")
             except Exception as e:
                 st.error(f"Failed: {e}")
@@ -232,8 +482,8 @@ with tabs[2]:
                     total += 1
                     user_ans = st.session_state.practice_answers.get(i)
                     correct_ans = q["answer"]
-                    if isinstance(correct_ans, str):
-                        is_correct = str(user_ans).strip().lower() == correct_ans.strip().lower()
+                    if "_norm_answer" in q:
+                        is_correct = str(user_ans).strip().lower() == q["_norm_answer"]
                     else:
                         is_correct = user_ans == correct_ans
                     if is_correct:
@@ -246,14 +496,25 @@ with tabs[2]:
             st.subheader(f"Final Score: {correct} / {total}")
 
 # -------------------- SUMMARY TAB --------------------
-with tabs[3]:
+@st.fragment
+def render_summary_tab(notes):
     st.subheader("Summarize Notes")
-    if st.button("📖 Summarize"):
-        with st.spinner("Summarizing..."):
-            try:
-                st.session_state.summary = ask_openrouter(SUMMARY_PROMPT, notes)
-                st.success("Summary generated!")
-            except Exception as e:
-                st.error(f"Failed: {e}")
-    if "summary" in st.session_state:
+    if st.button("📖 Summarize") and notes_ready(notes) and not already_generated("summary", notes):
+        try:
+            st.session_state.summary = st.write_stream(stream_openrouter("summary", notes))
+            remember_notes("summary", notes)
+            st.success("Summary generated!")
+        except Exception as e:
+            st.error(f"Failed: {e}")
+    elif "summary" in st.session_state:
         st.write(st.session_state.summary)
+
+tabs = st.tabs(["📝 Quiz", "🧠 Feynman", "📑 Practice Test", "📖 Summary"])
+with tabs[0]:
+    render_quiz_tab(notes)
+with tabs[1]:
+    render_feynman_tab(notes)
+with tabs[2]:
+    render_practice_test_tab(notes)
+with tabs[3]:
+    render_summary_tab(notes)